@@ -1,10 +1,7 @@
-import hashlib
+import concurrent.futures
 import hmac
 import random
 import re
-import socket
-import struct
-import subprocess
 
 import goodix
 import protocol
@@ -12,11 +9,19 @@ import tool
 
 TARGET_FIRMWARE = "GFUSB_GM168SEC_APP_10019"
 IAP_FIRMWARE = "MILAN_GM168SEC_IAP_10007"
-VALID_FIRMWARE = "GFUSB_GM168SEC_APP_100[0-9]{2}"
+VALID_FIRMWARE = re.compile("GFUSB_GM168SEC_APP_100[0-9]{2}")
 
 PSK = bytes.fromhex(
     "0000000000000000000000000000000000000000000000000000000000000000")
 
+# SHA-256 of (struct.pack(">H", len(PSK)) + PSK) * 2
+PMK = bytes.fromhex(
+    "a3a39d634056a057f6a8c14bb44df3890754fff7c4998ba09555e4bfae4824aa")
+
+# HMAC-SHA-256 of bytes(range(1, 65)) keyed with PMK
+PMK_HMAC = bytes.fromhex(
+    "0ac39058f7e4bc0025a18bd069e7a04ea4399531175a3b1726b22e4e4266983a")
+
 PSK_WHITE_BOX = bytes.fromhex(
     "ec35ae3abb45ed3f12c4751f1e5c2cc05b3c5452e9104d9f2a3118644f37a04b"
     "6fd66b1d97cf80f1345f76c84f03ff30bb51bf308f2a9875c41e6592cd2a2f9e"
@@ -39,6 +44,24 @@ DEVICE_POV_CONFIG = bytes.fromhex(
     "040f8d8d868697978f8f9b9b929296968c8c00000000000000000803a700a100"
     "a700a3000a020503")
 
+FDT_CONFIG = b"\x01\x27\x01\x21\x01\x27\x01\x23\x01"
+
+FDT_BASE = bytes.fromhex("8d8d868697978f8f9b9b929296968c8c")
+
+FDT_MODE_0 = b"\x0d" + FDT_CONFIG + bytes(16) + b"\x00"
+FDT_MODE_1 = b"\x0d" + FDT_CONFIG + bytes(16) + b"\x01"
+
+FDT_MODE_TX_DISABLED_0 = b"\x8d" + FDT_CONFIG + bytes(16) + b"\x00"
+FDT_MODE_TX_DISABLED_1 = b"\x8d" + FDT_CONFIG + bytes(16) + b"\x01"
+
+FDT_MODE_BASE_0 = b"\x0d" + FDT_CONFIG + FDT_BASE + b"\x00"
+FDT_MODE_BASE_1 = b"\x0d" + FDT_CONFIG + FDT_BASE + b"\x01"
+
+FDT_DOWN_0 = (b"\x9c" + FDT_CONFIG + FDT_BASE + b"\x00" +
+              bytes.fromhex("000503a700a100a700a30000"))
+FDT_DOWN_1 = (b"\x9c" + FDT_CONFIG + FDT_BASE + b"\x01" +
+              bytes.fromhex("000503a700a100a700a30000"))
+
 SENSOR_WIDTH = 80
 SENSOR_HEIGHT = 64
 
@@ -77,26 +100,27 @@ def erase_firmware(device: goodix.Device):
     device.mcu_erase_app(50, True)
 
 
-def update_firmware(device: goodix.Device):
-    firmware_file = open(f"firmware/52xd/{TARGET_FIRMWARE}.bin", "rb")
-    firmware = firmware_file.read()
-    firmware_file.close()
+def update_firmware(device: goodix.Device, chunk_size: int = 256):
+    with open(f"firmware/52xd/{TARGET_FIRMWARE}.bin", "rb") as firmware_file:
+        firmware = firmware_file.read()
 
-    mod = b""
-    for i in range(1, 65):
-        mod += struct.pack("<B", i)
-    raw_pmk = (struct.pack(">H", len(PSK)) + PSK) * 2
-    pmk = hashlib.sha256(raw_pmk).digest()
-    pmk_hmac = hmac.new(pmk, mod, hashlib.sha256).digest()
-    firmware_hmac = hmac.new(pmk_hmac, firmware, hashlib.sha256).digest()
+    # hashlib releases the GIL, so the HMAC is computed during the writes
+    executor = concurrent.futures.ThreadPoolExecutor(1)
+    firmware_hmac = executor.submit(hmac.digest, PMK_HMAC, firmware, "sha256")
+    executor.shutdown(wait=False)
 
     try:
+        firmware_view = memoryview(firmware)
         length = len(firmware)
-        for i in range(0, length, 256):
-            if not device.write_firmware(i, firmware[i:i + 256], 2):
+        # Writes can't be pipelined: the MCU handles one command at a time
+        # and answers each one with an ACK and a reply on the same endpoint
+        for i in range(0, length, chunk_size):
+            if not device.write_firmware(i, firmware_view[i:i + chunk_size],
+                                         2):
                 raise ValueError("Failed to write firmware")
 
-        if not device.check_firmware(None, None, None, firmware_hmac):
+        if not device.check_firmware(None, None, None,
+                                     firmware_hmac.result()):
             raise ValueError("Failed to check firmware")
 
     except Exception as error:
@@ -114,12 +138,7 @@ def update_firmware(device: goodix.Device):
 
 
 def run_driver(device: goodix.Device):
-    tls_server = subprocess.Popen([
-        "openssl", "s_server", "-nocert", "-psk",
-        PSK.hex(), "-port", "4433", "-quiet"
-    ],
-                                  stdout=subprocess.PIPE,
-                                  stderr=subprocess.STDOUT)
+    tls_server = tool.TLSServer(PSK)
 
     try:
         if not device.reset(True, False, 20)[0]:
@@ -142,12 +161,14 @@ def run_driver(device: goodix.Device):
         #        ea2f04009c0053f00729312ba8b0aa00
         #        000000000000000000000000f3830000
 
-        tls_client = socket.socket()
-        tls_client.connect(("localhost", 4433))
+        tls_client = tls_server.connect()
 
         try:
             tool.connect_device(device, tls_client)
 
+            frame = bytearray(7684)
+            image = memoryview(frame)[:-4]
+
             if not device.upload_config_mcu(DEVICE_CONFIG):
                 raise ValueError("Failed to upload config")
 
@@ -155,16 +176,8 @@ def run_driver(device: goodix.Device):
 
             device.mcu_get_pov_image()
 
-            device.mcu_switch_to_fdt_mode(
-                b"\x0d\x01\x27\x01\x21\x01\x27\x01"
-                b"\x23\x01\x00\x00\x00\x00\x00\x00"
-                b"\x00\x00\x00\x00\x00\x00\x00\x00"
-                b"\x00\x00\x00", False)
-            device.mcu_switch_to_fdt_mode(
-                b"\x0d\x01\x27\x01\x21\x01\x27\x01"
-                b"\x23\x01\x00\x00\x00\x00\x00\x00"
-                b"\x00\x00\x00\x00\x00\x00\x00\x00"
-                b"\x00\x00\x01", True)
+            device.mcu_switch_to_fdt_mode(FDT_MODE_0, False)
+            device.mcu_switch_to_fdt_mode(FDT_MODE_1, True)
 
             device.write_sensor_register(0x022c, b"\x0a\x03")
 
@@ -173,9 +186,9 @@ def run_driver(device: goodix.Device):
                     b"\x01\x03\x27\x01\x21\x01\x27\x01\x23\x01",
                     goodix.FLAGS_TRANSPORT_LAYER_SECURITY_DATA)[9:])
 
-            tool.write_pgm(
-                tool.decode_image(tls_server.stdout.read(7684)[:-4]),
-                SENSOR_WIDTH, SENSOR_HEIGHT, "clear-0.pgm")
+            tls_server.readinto(frame)
+            tool.write_pgm(tool.decode_image(image), SENSOR_WIDTH,
+                           SENSOR_HEIGHT, "clear-0.pgm")
 
             device.write_sensor_register(0x022c, b"\x0a\x02")
 
@@ -186,9 +199,9 @@ def run_driver(device: goodix.Device):
                     b"\x81\x03\x27\x01\x21\x01\x27\x01\x23\x01",
                     goodix.FLAGS_TRANSPORT_LAYER_SECURITY_DATA)[9:])
 
-            tool.write_pgm(
-                tool.decode_image(tls_server.stdout.read(7684)[:-4]),
-                SENSOR_WIDTH, SENSOR_HEIGHT, "clear-1.pgm")
+            tls_server.readinto(frame)
+            tool.write_pgm(tool.decode_image(image), SENSOR_WIDTH,
+                           SENSOR_HEIGHT, "clear-1.pgm")
 
             device.write_sensor_register(0x022c, b"\x0a\x02")
 
@@ -199,22 +212,14 @@ def run_driver(device: goodix.Device):
                     b"\x81\x03\x18\x01\x12\x01\x18\x01\x14\x01",
                     goodix.FLAGS_TRANSPORT_LAYER_SECURITY_DATA)[9:])
 
-            tool.write_pgm(
-                tool.decode_image(tls_server.stdout.read(7684)[:-4]),
-                SENSOR_WIDTH, SENSOR_HEIGHT, "clear-2.pgm")
+            tls_server.readinto(frame)
+            tool.write_pgm(tool.decode_image(image), SENSOR_WIDTH,
+                           SENSOR_HEIGHT, "clear-2.pgm")
 
             device.write_sensor_register(0x022c, b"\x0a\x02")
 
-            device.mcu_switch_to_fdt_mode(
-                b"\x8d\x01\x27\x01\x21\x01\x27\x01"
-                b"\x23\x01\x00\x00\x00\x00\x00\x00"
-                b"\x00\x00\x00\x00\x00\x00\x00\x00"
-                b"\x00\x00\x00", False)
-            device.mcu_switch_to_fdt_mode(
-                b"\x8d\x01\x27\x01\x21\x01\x27\x01"
-                b"\x23\x01\x00\x00\x00\x00\x00\x00"
-                b"\x00\x00\x00\x00\x00\x00\x00\x00"
-                b"\x00\x00\x01", True)
+            device.mcu_switch_to_fdt_mode(FDT_MODE_TX_DISABLED_0, False)
+            device.mcu_switch_to_fdt_mode(FDT_MODE_TX_DISABLED_1, True)
 
             device.write_sensor_register(0x022c, b"\x0a\x03")
 
@@ -223,22 +228,14 @@ def run_driver(device: goodix.Device):
                     b"\x81\x03\x27\x01\x21\x01\x27\x01\x23\x01",
                     goodix.FLAGS_TRANSPORT_LAYER_SECURITY_DATA)[9:])
 
-            tool.write_pgm(
-                tool.decode_image(tls_server.stdout.read(7684)[:-4]),
-                SENSOR_WIDTH, SENSOR_HEIGHT, "clear-3.pgm")
+            tls_server.readinto(frame)
+            tool.write_pgm(tool.decode_image(image), SENSOR_WIDTH,
+                           SENSOR_HEIGHT, "clear-3.pgm")
 
             device.write_sensor_register(0x022c, b"\x0a\x02")
 
-            device.mcu_switch_to_fdt_mode(
-                b"\x0d\x01\x27\x01\x21\x01\x27\x01"
-                b"\x23\x01\x00\x00\x00\x00\x00\x00"
-                b"\x00\x00\x00\x00\x00\x00\x00\x00"
-                b"\x00\x00\x00", False)
-            device.mcu_switch_to_fdt_mode(
-                b"\x0d\x01\x27\x01\x21\x01\x27\x01"
-                b"\x23\x01\x00\x00\x00\x00\x00\x00"
-                b"\x00\x00\x00\x00\x00\x00\x00\x00"
-                b"\x00\x00\x01", True)
+            device.mcu_switch_to_fdt_mode(FDT_MODE_0, False)
+            device.mcu_switch_to_fdt_mode(FDT_MODE_1, True)
 
             device.set_pov_config(DEVICE_POV_CONFIG)
 
@@ -246,19 +243,9 @@ def run_driver(device: goodix.Device):
 
             device.query_mcu_state(b"\x01\x01\x01", False)
 
-            device.mcu_switch_to_fdt_down(
-                b"\x9c\x01\x27\x01\x21\x01\x27\x01"
-                b"\x23\x01\x8d\x8d\x86\x86\x97\x97"
-                b"\x8f\x8f\x9b\x9b\x92\x92\x96\x96"
-                b"\x8c\x8c\x00\x00\x05\x03\xa7\x00"
-                b"\xa1\x00\xa7\x00\xa3\x00\x00", False)
+            device.mcu_switch_to_fdt_down(FDT_DOWN_0, False)
 
-            device.mcu_switch_to_fdt_down(
-                b"\x9c\x01\x27\x01\x21\x01\x27\x01"
-                b"\x23\x01\x8d\x8d\x86\x86\x97\x97"
-                b"\x8f\x8f\x9b\x9b\x92\x92\x96\x96"
-                b"\x8c\x8c\x01\x00\x05\x03\xa7\x00"
-                b"\xa1\x00\xa7\x00\xa3\x00\x00", False)
+            device.mcu_switch_to_fdt_down(FDT_DOWN_1, False)
 
             device.mcu_switch_to_sleep_mode()
 
@@ -266,33 +253,15 @@ def run_driver(device: goodix.Device):
 
             device.query_mcu_state(b"\x01\x01\x01", False)
 
-            device.mcu_switch_to_fdt_down(
-                b"\x9c\x01\x27\x01\x21\x01\x27\x01"
-                b"\x23\x01\x8d\x8d\x86\x86\x97\x97"
-                b"\x8f\x8f\x9b\x9b\x92\x92\x96\x96"
-                b"\x8c\x8c\x00\x00\x05\x03\xa7\x00"
-                b"\xa1\x00\xa7\x00\xa3\x00\x00", False)
+            device.mcu_switch_to_fdt_down(FDT_DOWN_0, False)
 
             print("Waiting for finger...")
 
-            device.mcu_switch_to_fdt_down(
-                b"\x9c\x01\x27\x01\x21\x01\x27\x01"
-                b"\x23\x01\x8d\x8d\x86\x86\x97\x97"
-                b"\x8f\x8f\x9b\x9b\x92\x92\x96\x96"
-                b"\x8c\x8c\x01\x00\x05\x03\xa7\x00"
-                b"\xa1\x00\xa7\x00\xa3\x00\x00", True)
-
-            device.mcu_switch_to_fdt_mode(
-                b"\x0d\x01\x27\x01\x21\x01\x27\x01"
-                b"\x23\x01\x8d\x8d\x86\x86\x97\x97"
-                b"\x8f\x8f\x9b\x9b\x92\x92\x96\x96"
-                b"\x8c\x8c\x00", False)
-
-            device.mcu_switch_to_fdt_mode(
-                b"\x0d\x01\x27\x01\x21\x01\x27\x01"
-                b"\x23\x01\x8d\x8d\x86\x86\x97\x97"
-                b"\x8f\x8f\x9b\x9b\x92\x92\x96\x96"
-                b"\x8c\x8c\x01", True)
+            device.mcu_switch_to_fdt_down(FDT_DOWN_1, True)
+
+            device.mcu_switch_to_fdt_mode(FDT_MODE_BASE_0, False)
+
+            device.mcu_switch_to_fdt_mode(FDT_MODE_BASE_1, True)
 
             device.write_sensor_register(0x022c, b"\x05\x03")
 
@@ -301,14 +270,14 @@ def run_driver(device: goodix.Device):
                     b"\x45\x03\xa7\x00\xa1\x00\xa7\x00\xa3\x00",
                     goodix.FLAGS_TRANSPORT_LAYER_SECURITY_DATA)[9:])
 
-            tool.write_pgm(
-                tool.decode_image(tls_server.stdout.read(7684)[:-4]),
-                SENSOR_WIDTH, SENSOR_HEIGHT, "fingerprint.pgm")
+            tls_server.readinto(frame)
+            tool.write_pgm(tool.decode_image(image), SENSOR_WIDTH,
+                           SENSOR_HEIGHT, "fingerprint.pgm")
 
         finally:
             tls_client.close()
     finally:
-        tls_server.terminate()
+        tls_server.close()
 
 
 def main(product: int):
@@ -343,7 +312,7 @@ def main(product: int):
 
         previous_firmware = firmware
 
-        if re.fullmatch(TARGET_FIRMWARE, firmware):
+        if firmware == TARGET_FIRMWARE:
             if not valid_psk:
                 erase_firmware(device)
                 continue
@@ -351,11 +320,11 @@ def main(product: int):
             run_driver(device)
             return
 
-        if re.fullmatch(VALID_FIRMWARE, firmware):
+        if VALID_FIRMWARE.fullmatch(firmware):
             erase_firmware(device)
             continue
 
-        if re.fullmatch(IAP_FIRMWARE, firmware):
+        if firmware == IAP_FIRMWARE:
             if not valid_psk:
                 if not write_psk(device):
                     raise ValueError("Failed to write PSK")
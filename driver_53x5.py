@@ -1,3 +1,4 @@
+import array
 import dataclasses
 import logging
 import os
@@ -112,7 +113,7 @@ class CalibrationParams:
     fdt_base_up: bytes
     fdt_base_manual: bytes
 
-    calib_image: list[int] | None
+    calib_image: array.array | None
 
     def update_fdt_bases(self, fdt_base: bytes):
         assert len(fdt_base) == FDT_BASE_LEN
@@ -265,7 +266,7 @@ def get_fdt_base_with_tx(device: wrapless.Device, tx_enable: bool,
     return fdt_base
 
 
-def get_adjusted_dac(sensor_image: list[int], calib_image: list[int],
+def get_adjusted_dac(sensor_image: array.array, calib_image: array.array,
                      dac: int):
     raise NotImplementedError
 
@@ -333,7 +334,7 @@ def is_fdt_base_valid(fdt_data_1: bytes, fdt_data_2: bytes, max_delta: int):
     return True
 
 
-def validate_base_img(base_image_1: list[int], base_image_2: list[int],
+def validate_base_img(base_image_1: array.array, base_image_2: array.array,
                       image_threshold: int):
     assert len(base_image_1) == SENSOR_WIDTH * SENSOR_HEIGHT
     assert len(base_image_2) == SENSOR_WIDTH * SENSOR_HEIGHT
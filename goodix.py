@@ -787,9 +787,9 @@ class Device:
 
     def write_firmware(self,
                        offset: int,
-                       payload: bytes,
+                       payload: bytes | memoryview,
                        number: int | None = None):
-        print(f"write_firmware({offset}, {payload}, {number})")
+        print(f"write_firmware({offset}, {bytes(payload)}, {number})")
 
         self.protocol.write(
             encode_message_pack(
@@ -1,4 +1,9 @@
+import array
 import socket
+import ssl
+import subprocess
+import sys
+import threading
 import time
 
 import goodix
@@ -9,11 +14,116 @@ def warning(text: str):
     return f"\033[31;5m{decorator}\n{text}\n{decorator}\033[0m"
 
 
+class TLSServer:
+
+    def __init__(self, psk: bytes):
+        self.psk = psk
+
+        self.process: subprocess.Popen | None = None
+        self.socket: ssl.SSLSocket | None = None
+        self.handshake: threading.Thread | None = None
+        self.handshake_error: Exception | None = None
+
+        # Python 3.13+ can serve PSK cipher suites in-process, older versions
+        # rely on the openssl command line tool
+        if not hasattr(ssl.SSLContext, "set_psk_server_callback"):
+            self.process = subprocess.Popen([
+                "openssl", "s_server", "-nocert", "-psk",
+                psk.hex(), "-port", "4433", "-quiet"
+            ],
+                                            bufsize=0,
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT)
+
+    def connect(self):
+        if self.process is not None:
+            tls_client = socket.socket()
+            tls_client.connect(("localhost", 4433))
+
+            return tls_client
+
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.maximum_version = ssl.TLSVersion.TLSv1_2
+        context.set_ciphers("PSK")
+        context.set_psk_server_callback(lambda identity: self.psk)
+
+        tls_server, tls_client = socket.socketpair()
+        self.socket = context.wrap_socket(tls_server,
+                                          server_side=True,
+                                          do_handshake_on_connect=False)
+
+        # The handshake messages are relayed by connect_device
+        self.handshake = threading.Thread(target=self._do_handshake,
+                                          daemon=True)
+        self.handshake.start()
+
+        return tls_client
+
+    def _do_handshake(self):
+        try:
+            self.socket.do_handshake()
+
+        except Exception as error:
+            self.handshake_error = error
+
+    def readinto(self, buffer: bytearray):
+        if self.process is not None:
+            # The pipe is unbuffered, so short reads land in the buffer as is
+            receive = self.process.stdout.readinto
+        else:
+            self.handshake.join()
+            if self.handshake_error is not None:
+                raise self.handshake_error
+
+            receive = self.socket.recv_into
+
+        view = memoryview(buffer)
+        length = 0
+        while length < len(buffer):
+            received = receive(view[length:])
+            if not received:
+                raise ConnectionError("TLS connection closed")
+
+            length += received
+
+    def close(self):
+        if self.process is not None:
+            self.process.terminate()
+
+        if self.socket is not None:
+            self.socket.close()
+
+
+def recv_tls_records(tls_client: socket.socket, buffer: bytearray):
+    view = memoryview(buffer)
+    length = 0
+    offset = 0
+
+    # Keep receiving until the last TLS record is complete
+    while True:
+        if length == len(buffer):
+            raise ValueError("TLS records too large")
+
+        received = tls_client.recv_into(view[length:])
+        if not received:
+            raise ConnectionError("TLS connection closed")
+
+        length += received
+
+        while offset + 5 <= length:
+            offset += 5 + int.from_bytes(buffer[offset + 3:offset + 5], "big")
+
+        if offset == length:
+            return bytes(view[:length])
+
+
 def connect_device(device: goodix.Device, tls_client: socket.socket):
+    buffer = bytearray(8192)
+
     tls_client.sendall(device.request_tls_connection())
 
     device.protocol.write(
-        goodix.encode_message_pack(tls_client.recv(1024),
+        goodix.encode_message_pack(recv_tls_records(tls_client, buffer),
                                    goodix.FLAGS_TRANSPORT_LAYER_SECURITY))
 
     tls_client.sendall(
@@ -27,14 +137,17 @@ def connect_device(device: goodix.Device, tls_client: socket.socket):
                                   goodix.FLAGS_TRANSPORT_LAYER_SECURITY))
 
     device.protocol.write(
-        goodix.encode_message_pack(tls_client.recv(1024),
+        goodix.encode_message_pack(recv_tls_records(tls_client, buffer),
                                    goodix.FLAGS_TRANSPORT_LAYER_SECURITY))
 
-    time.sleep(0.01)  # Important otherwise an USBTimeout error occur
+    # Important otherwise an USBTimeout error occur. The MCU doesn't answer
+    # the last handshake message and no command can be used to poll it while
+    # the TLS session is being set up, so a fixed delay is the only option.
+    time.sleep(0.01)
 
 
-def decode_image(data: bytes):
-    image: list[int] = []
+def decode_image(data: bytes | memoryview):
+    image = array.array("H")
     for i in range(0, len(data), 6):
         chunk = data[i:i + 6]
 
@@ -46,14 +159,12 @@ def decode_image(data: bytes):
     return image
 
 
-def write_pgm(image: list[int], width: int, height: int, path: str):
-    img_str = ""
+def write_pgm(image: array.array, width: int, height: int, path: str):
     print(f"image: {width} x {height}, length: {len(image)}")
-    for i in range(len(image)):
-        if (i % (width + 8)) == 0:
-            img_str += "\n"
-        img_str += str(image[i]) + " "
-
-    file = open(path, "w")
-    file.write(f"P2\n{height} {width}\n4095\n")
-    file.write("\n" + img_str)
+
+    data = array.array("H", image)
+    if sys.byteorder == "little":
+        data.byteswap()  # PGM stores 16-bit samples in big-endian order
+
+    with open(path, "wb") as file:
+        file.write(f"P5\n{height} {width}\n4095\n".encode() + data.tobytes())